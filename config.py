@@ -102,9 +102,27 @@ SCHEDULE_URLS = {
 }
 
 
+# Пул соединений с базой, создается при старте бота
+DB_POOL = None
+
+
+async def init_db_pool():
+    """Создает пул соединений с базой данных."""
+    global DB_POOL
+    DB_POOL = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+
+
+async def close_db_pool():
+    """Закрывает пул соединений с базой данных."""
+    global DB_POOL
+    if DB_POOL is not None:
+        await DB_POOL.close()
+        DB_POOL = None
+
+
 async def create_tables():
     """Создает таблицы users и notes в базе данных, если они не существуют."""
-    conn = await asyncpg.connect(DATABASE_URL)
+    conn = await DB_POOL.acquire()
     try:
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -130,12 +148,13 @@ async def create_tables():
         print("✅ Таблицы users и notes созданы/проверены")
     except Exception as e:
         print(f"❌ Ошибка создания таблиц: {e}")
+        raise
     finally:
-        await conn.close()
+        await DB_POOL.release(conn)
 
 
 async def update_user_data(user_id, user_info):
-    conn = await asyncpg.connect(DATABASE_URL)
+    conn = await DB_POOL.acquire()
     try:
         await conn.execute('''
             INSERT INTO users (user_id, faculty, course, group_name, username, full_name)
@@ -146,32 +165,32 @@ async def update_user_data(user_id, user_info):
         ''', user_id, user_info['faculty'], user_info['course'], 
             user_info['group'], user_info['username'], user_info['full_name'])
     finally:
-        await conn.close()
+        await DB_POOL.release(conn)
 
 
 async def remove_user_data(user_id):
-    conn = await asyncpg.connect(DATABASE_URL)
+    conn = await DB_POOL.acquire()
     try:
         await conn.execute('DELETE FROM users WHERE user_id = $1', user_id)
         return True
     except:
         return False
     finally:
-        await conn.close()
+        await DB_POOL.release(conn)
 
 
 async def get_user_data(user_id):
-    conn = await asyncpg.connect(DATABASE_URL)
+    conn = await DB_POOL.acquire()
     try:
         row = await conn.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
         return dict(row) if row else None
     finally:
-        await conn.close()
+        await DB_POOL.release(conn)
 
 
 async def add_or_update_note(user_id: int, note_date, note_text: str):
     """Добавляет или обновляет личную заметку пользователя."""
-    conn = await asyncpg.connect(DATABASE_URL)
+    conn = await DB_POOL.acquire()
     try:
         await conn.execute('''
             INSERT INTO notes (user_id, note_date, note_text)
@@ -180,12 +199,12 @@ async def add_or_update_note(user_id: int, note_date, note_text: str):
             DO UPDATE SET note_text = $3, created_at = CURRENT_TIMESTAMP
         ''', user_id, note_date, note_text)
     finally:
-        await conn.close()
+        await DB_POOL.release(conn)
 
 
 async def get_note(user_id: int, note_date):
     """Получает личную заметку пользователя."""
-    conn = await asyncpg.connect(DATABASE_URL)
+    conn = await DB_POOL.acquire()
     try:
         row = await conn.fetchrow(
             'SELECT note_text FROM notes WHERE user_id = $1 AND note_date = $2',
@@ -193,14 +212,14 @@ async def get_note(user_id: int, note_date):
         )
         return row['note_text'] if row else None
     finally:
-        await conn.close()
+        await DB_POOL.release(conn)
 
 
 async def delete_note(user_id: int, note_date):
     """Удаляет личную заметку пользователя."""
-    conn = await asyncpg.connect(DATABASE_URL)
+    conn = await DB_POOL.acquire()
     try:
         await conn.execute('DELETE FROM notes WHERE user_id = $1 AND note_date = $2', user_id, note_date)
         return True
     finally:
-        await conn.close()
+        await DB_POOL.release(conn)
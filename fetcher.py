@@ -0,0 +1,112 @@
+import asyncio
+import random
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import aiohttp
+
+# ===== НАСТРОЙКИ ЗАГРУЗКИ =====
+REQUEST_TIMEOUT_SECONDS = 5     # на одну попытку
+FETCH_DEADLINE_SECONDS = 12     # на все попытки вместе, чтобы хендлер не зависал
+MAX_ATTEMPTS = 3
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 4
+BREAKER_FAILURE_THRESHOLD = 5   # подряд неудачных загрузок с хоста до размыкания
+BREAKER_RESET_SECONDS = 60      # через сколько пропустить пробный запрос
+
+# Счетчики для мониторинга, отдаются на /metrics
+FETCH_STATS = defaultdict(int)
+
+
+class FetchError(Exception):
+    """Не удалось скачать файл расписания."""
+
+
+class CircuitOpenError(FetchError):
+    """Хост недавно много раз отвечал ошибками, запросы к нему временно не отправляются."""
+
+
+class CircuitBreaker:
+    """
+    Размыкается после BREAKER_FAILURE_THRESHOLD неудачных загрузок подряд (каждая уже с повторами
+    и только из-за таймаутов или ошибок соединения). Пока разомкнут, раз в BREAKER_RESET_SECONDS
+    пропускает один пробный запрос; успешный запрос замыкает его.
+    """
+
+    def __init__(self, threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def allow(self) -> bool:
+        if not self.is_open: return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_seconds: return False
+        # Пробный запрос: остальные ждут следующего окна, пока он не завершится успехом
+        self.opened_at = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures == self.threshold: FETCH_STATS["circuit_opened"] += 1
+        if self.is_open: self.opened_at = time.monotonic()
+
+
+# хост -> CircuitBreaker
+BREAKERS = {}
+
+
+def _backoff(attempt: int) -> float:
+    # Экспоненциальная задержка с полным джиттером
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+async def fetch_bytes(url: str) -> bytes:
+    """Скачивает файл с таймаутами и повторами. При неудаче бросает FetchError."""
+    host = urlsplit(url).hostname
+    breaker = BREAKERS.setdefault(host, CircuitBreaker())
+    deadline = time.monotonic() + FETCH_DEADLINE_SECONDS
+    host_failed = False
+    for attempt in range(MAX_ATTEMPTS):
+        if not breaker.allow():
+            FETCH_STATS["circuit_rejected"] += 1
+            raise CircuitOpenError(f"{host}: слишком много ошибок, запросы приостановлены")
+        FETCH_STATS["requests"] += 1
+        timeout = aiohttp.ClientTimeout(total=min(REQUEST_TIMEOUT_SECONDS, deadline - time.monotonic()))
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        content = await response.read()
+                        breaker.record_success()
+                        return content
+                    if response.status < 500 and response.status != 429:
+                        # Хост жив, просто файла нет: повторять бессмысленно
+                        breaker.record_success()
+                        FETCH_STATS["http_errors"] += 1
+                        raise FetchError(f"{url}: HTTP {response.status}")
+                    FETCH_STATS["http_errors"] += 1
+        except asyncio.TimeoutError:
+            FETCH_STATS["timeouts"] += 1
+            host_failed = True
+        except aiohttp.ClientError:
+            FETCH_STATS["connection_errors"] += 1
+            host_failed = True
+        FETCH_STATS["failures"] += 1
+
+        delay = _backoff(attempt)
+        if attempt + 1 == MAX_ATTEMPTS or time.monotonic() + delay >= deadline: break
+        FETCH_STATS["retries"] += 1
+        await asyncio.sleep(delay)
+    # В выключатель идет одна ошибка на файл, а не на попытку, и только если не отвечал сам хост:
+    # иначе один битый файл за пару обновлений закрыл бы все остальные
+    if host_failed: breaker.record_failure()
+    raise FetchError(f"{url}: не удалось скачать за {MAX_ATTEMPTS} попыток")
@@ -1,18 +1,32 @@
+import asyncio
+import contextlib
+import time
 from aiogram import Router, F, Bot, types
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.filters import Command
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, ErrorEvent
+from aiogram.filters import Command, ExceptionTypeFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
 from datetime import datetime, timedelta
 
 from config import FACULTIES, update_user_data, remove_user_data, get_user_data, TZ, add_or_update_note, delete_note
 from states import Registration, TeacherSearch, Notes
-from schedule_parser import get_day_schedule, get_available_groups, get_teacher_schedule
+from middlewares import SendQueueOverflow
+from schedule_parser import get_day_schedule, get_available_groups, iter_teacher_schedule, format_teacher_schedule, escape_markdown
 
 router = Router()
 
 CHANNEL_USERNAME = "@smartschedule0"
 
+# Текущие поиски преподавателя: user_id -> задача поиска
+TEACHER_SEARCHES = {}
+# Как часто обновлять сообщение с частичными результатами поиска
+PROGRESS_EDIT_INTERVAL = 1.5
+
+@router.errors(ExceptionTypeFilter(SendQueueOverflow))
+async def send_queue_overflow(event: ErrorEvent):
+    # Очередь отправки перегружена и уже посчитала отброшенное сообщение, это не ошибка хендлера
+    return True
+
 def get_subscription_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📢 Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME[1:]}")],
@@ -224,6 +238,9 @@ def get_teacher_search_keyboard():
 
 @router.message(F.text, lambda msg: len(msg.text.split()) >= 2)
 async def handle_teacher_name(message: Message, state: FSMContext):
+    # Новый поиск прерывает предыдущий, если тот еще идет
+    search = TEACHER_SEARCHES.pop(message.from_user.id, None)
+    if search: search.cancel()
     teacher_name = message.text.strip()
     await state.set_state(TeacherSearch.choosing_date)
     await state.update_data(teacher_name=teacher_name)
@@ -233,7 +250,35 @@ async def handle_teacher_name(message: Message, state: FSMContext):
         parse_mode=ParseMode.MARKDOWN
     )
 
-@router.callback_query(TeacherSearch.choosing_date, F.data.startswith("teacher_date_"))
+async def run_teacher_search(message: Message, teacher_name: str, target_date: datetime) -> list:
+    """Ищет пары преподавателя, по ходу поиска обновляя сообщение найденным."""
+    findings, shown, last_edit = [], 0, 0.0
+    try:
+        # aclosing гарантирует, что при любой ошибке генератор отменит свои загрузки
+        async with contextlib.aclosing(iter_teacher_schedule(teacher_name, target_date)) as results:
+            # Показываем найденное по мере обработки файлов, но не чаще раза в PROGRESS_EDIT_INTERVAL
+            async for done, total, workbook_findings in results:
+                findings.extend(workbook_findings)
+                if len(findings) > shown and done < total and time.monotonic() - last_edit >= PROGRESS_EDIT_INTERVAL:
+                    progress = escape_markdown(f"⏳ Продолжаю поиск: {done}/{total}")
+                    try:
+                        await message.edit_text(
+                            f"{format_teacher_schedule(teacher_name, target_date, findings)}\n{progress}", parse_mode=ParseMode.MARKDOWN_V2
+                        )
+                    except SendQueueOverflow:
+                        # Бот перегружен: промежуточное обновление не важно, покажем итог
+                        pass
+                    shown, last_edit = len(findings), time.monotonic()
+    except asyncio.CancelledError:
+        stopped = escape_markdown("⏹ Поиск прерван.")
+        text = f"{format_teacher_schedule(teacher_name, target_date, findings)}\n{stopped}" if findings else stopped
+        # Ошибка этой правки не должна подменить собой отмену
+        with contextlib.suppress(Exception):
+            await message.edit_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+        raise
+    return findings
+
+@router.callback_query(TeacherSearch.choosing_date, F.data.startswith("teacher_date_"), flags={"expensive": True})
 async def handle_teacher_date_selection(callback_query: types.CallbackQuery, state: FSMContext):
     date_str = callback_query.data.split("_")[2]
     target_date = datetime.strptime(date_str, "%Y-%m-%d")
@@ -247,9 +292,21 @@ async def handle_teacher_date_selection(callback_query: types.CallbackQuery, sta
         return
 
     await callback_query.message.edit_text("⏳ Ищу расписание, это может занять несколько секунд...", reply_markup=None)
-    
-    schedule_text = await get_teacher_schedule(teacher_name, target_date)
-    
+
+    # Поиск идет в отдельной задаче, чтобы новый поиск мог отменить только его, а не весь апдейт
+    user_id = callback_query.from_user.id
+    search = asyncio.ensure_future(run_teacher_search(callback_query.message, teacher_name, target_date))
+    TEACHER_SEARCHES[user_id] = search
+    try:
+        findings = await search
+    except asyncio.CancelledError:
+        # Поиск отменен новым поиском (он уже убрал задачу из TEACHER_SEARCHES), состояние не трогаем
+        if TEACHER_SEARCHES.get(user_id) is search: raise
+        return
+    finally:
+        if TEACHER_SEARCHES.get(user_id) is search: del TEACHER_SEARCHES[user_id]
+
+    schedule_text = format_teacher_schedule(teacher_name, target_date, findings)
     await callback_query.message.edit_text(schedule_text, parse_mode=ParseMode.MARKDOWN_V2)
-    
+
     await state.clear()
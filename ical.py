@@ -0,0 +1,172 @@
+import asyncio
+import gzip
+import hashlib
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+from config import TZ
+from schedule_parser import (
+    SCHEDULE_CACHE, CACHE_DURATION_SECONDS, REFRESH_FAILED_AT, REFRESH_TASKS, get_all_schedule_urls,
+    get_schedule_data_from_url, get_schedule_version, find_group_column, parse_russian_date
+)
+
+# ===== КЭШ ГОТОВЫХ КАЛЕНДАРЕЙ =====
+# группа -> (((url, версия файла), ...), дата сборки, ETag, тело, тело в gzip)
+ICAL_CACHE = {}
+# Увеличивать при любом изменении формата календаря, чтобы клиенты не получали 304 со старым телом
+ICAL_FORMAT_VERSION = 1
+# (версии закэшированных файлов, {группа: [url, ...]}), пересобирается при изменении файлов
+GROUP_INDEX = (None, {})
+
+
+class FeedUnavailable(Exception):
+    """Файлы расписания еще не загружены или сервер расписаний недоступен."""
+
+TIME_RE = re.compile(r'(\d{1,2})[:.](\d{2})(?:\s*[-–—]\s*(\d{1,2})[:.](\d{2}))?')
+DEFAULT_LESSON_MINUTES = 90
+
+
+def _escape(text: str) -> str:
+    return (str(text).replace("\\", "\\\\").replace(";", "\\;")
+            .replace(",", "\\,").replace("\n", "\\n"))
+
+def _fold(line: str) -> bytes:
+    """Переносит строку длиннее 75 байт, не разрезая символы UTF-8 (RFC 5545, 3.1)."""
+    raw = line.encode("utf-8")
+    parts, limit = [], 75
+    while len(raw) > limit:
+        cut = limit
+        while (raw[cut] & 0xC0) == 0x80: cut -= 1
+        parts.append(raw[:cut])
+        raw, limit = raw[cut:], 74
+    parts.append(raw)
+    return b"\r\n ".join(parts)
+
+def _utc(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+def _semester_date(parsed: datetime, now: datetime):
+    # parse_russian_date переносит прошедшие даты на следующий год, для семестра это неверно
+    if parsed - now > timedelta(days=183):
+        try: return parsed.replace(year=parsed.year - 1)
+        except ValueError: return None
+    return parsed
+
+def _lesson_bounds(day: datetime, time_cell: str):
+    match = TIME_RE.search(time_cell)
+    if not match: return None
+    h1, m1, h2, m2 = match.groups()
+    try:
+        start = day.replace(hour=int(h1), minute=int(m1), tzinfo=TZ)
+        end = day.replace(hour=int(h2), minute=int(m2), tzinfo=TZ) if h2 else start + timedelta(minutes=DEFAULT_LESSON_MINUTES)
+    except ValueError: return None
+    return start, end if end > start else start + timedelta(minutes=DEFAULT_LESSON_MINUTES)
+
+def _group_lessons(schedule_data: list, group_column: int):
+    """Все пары группы из одного файла: (начало, конец, строки предмета)."""
+    now = datetime.now(TZ).replace(tzinfo=None)
+    current_day, current_time = None, None
+    for row in schedule_data:
+        if row and row[0]:
+            parsed_date = parse_russian_date(str(row[0]))
+            if parsed_date:
+                current_day, current_time = _semester_date(parsed_date, now), None
+        if current_day is None: continue
+        time_cell = row[1] if len(row) > 1 else ""
+        if time_cell and str(time_cell).strip(): current_time = str(time_cell).strip()
+        subject_cell = row[group_column] if len(row) > group_column else ""
+        if not current_time or not str(subject_cell).strip(): continue
+        subject_lines = [line.strip().lstrip('-').strip() for line in str(subject_cell).split('\n') if line.strip()]
+        bounds = _lesson_bounds(current_day, current_time)
+        if subject_lines and bounds: yield bounds[0], bounds[1], subject_lines
+
+def render_group_calendar(group: str, sources: list) -> bytes:
+    """Собирает VCALENDAR группы из списка (данные файла, колонка группы)."""
+    stamp = _utc(datetime.now(TZ))
+    lines = [
+        "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//smartschedule0//Schedule Bot//RU",
+        "CALSCALE:GREGORIAN", "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{_escape(group)}", "X-WR-TIMEZONE:Asia/Yekaterinburg",
+        "REFRESH-INTERVAL;VALUE=DURATION:PT1H", "X-PUBLISHED-TTL:PT1H",
+    ]
+    seen = set()
+    for schedule_data, group_column in sources:
+        for start, end, subject_lines in _group_lessons(schedule_data, group_column):
+            uid = hashlib.sha1(f"{group}|{_utc(start)}|{subject_lines}".encode("utf-8")).hexdigest()
+            if uid in seen: continue
+            seen.add(uid)
+            lines += [
+                "BEGIN:VEVENT", f"UID:{uid}@smartschedule0", f"DTSTAMP:{stamp}",
+                f"DTSTART:{_utc(start)}", f"DTEND:{_utc(end)}",
+                f"SUMMARY:{_escape(subject_lines[0])}",
+            ]
+            if len(subject_lines) > 1: lines.append(f"DESCRIPTION:{_escape(chr(10).join(subject_lines[1:]))}")
+            lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return b"\r\n".join(_fold(line) for line in lines) + b"\r\n"
+
+def _header_groups(schedule_data: list) -> list:
+    for row in schedule_data:
+        if len(row) > 2 and "день" in str(row[0]).lower() and "часы" in str(row[1]).lower():
+            return [str(cell).strip() for cell in row[2:] if str(cell).strip()]
+    return []
+
+def _known_groups() -> dict:
+    """Группы из уже закэшированных файлов: группа -> url файлов, где она есть."""
+    global GROUP_INDEX
+    versions = tuple((url, entry[2]) for url, entry in SCHEDULE_CACHE.items())
+    if GROUP_INDEX[0] != versions:
+        groups = {}
+        for url, entry in SCHEDULE_CACHE.items():
+            for group in _header_groups(entry[1]): groups.setdefault(group, []).append(url)
+        GROUP_INDEX = (versions, groups)
+    return GROUP_INDEX[1]
+
+def _is_fresh(url: str, version: str) -> bool:
+    entry = SCHEDULE_CACHE.get(url)
+    return bool(entry) and entry[2] == version and time.time() - entry[0] < CACHE_DURATION_SECONDS
+
+def _feed_pending() -> bool:
+    """True, пока часть файлов еще ни разу не пробовали скачать или они скачиваются прямо сейчас."""
+    if not SCHEDULE_CACHE: return True
+    return any(url in REFRESH_TASKS or (url not in SCHEDULE_CACHE and url not in REFRESH_FAILED_AT)
+               for url in get_all_schedule_urls())
+
+async def get_group_feed(group: str):
+    """
+    Возвращает (ETag, тело, тело в gzip) календаря группы или None, если группа не найдена.
+    Пока исходные файлы свежие, отдается готовый календарь без обращения к кэшу файлов;
+    пересобирается он только когда меняется хотя бы один из них. Бросает FeedUnavailable,
+    если про группу нельзя ничего сказать, потому что файлы еще загружаются или не загрузился ни один.
+    """
+    # Даты семестра зависят от текущего дня (см. _semester_date), поэтому календарь пересобирается раз в день
+    today = datetime.now(TZ).date()
+    cached = ICAL_CACHE.get(group)
+    if cached and cached[1] == today and all(_is_fresh(url, version) for url, version in cached[0]):
+        return cached[2:]
+
+    urls = sorted(_known_groups().get(group, []))
+    if not urls:
+        # Неизвестную группу не ищем по сети: либо ее нет, либо файлы еще не загружены
+        if _feed_pending(): raise FeedUnavailable(group)
+        return None
+
+    # Загрузки общие с остальными запросами, поэтому каждый файл обновляется один раз
+    all_data = await asyncio.gather(*(get_schedule_data_from_url(url) for url in urls))
+    sources, versions = [], []
+    for url, schedule_data in zip(urls, all_data):
+        group_column = find_group_column(schedule_data, group)
+        if group_column == -1: continue
+        sources.append((schedule_data, group_column))
+        versions.append((url, get_schedule_version(url)))
+    if not sources: return None
+
+    versions = tuple(versions)
+    if cached and cached[0] == versions and cached[1] == today: return cached[2:]
+
+    fingerprint = hashlib.sha1(repr((ICAL_FORMAT_VERSION, group, today.isoformat(), versions)).encode("utf-8")).hexdigest()
+    body = render_group_calendar(group, sources)
+    entry = (versions, today, f'"{fingerprint}"', body, gzip.compress(body))
+    ICAL_CACHE[group] = entry
+    return entry[2:]
@@ -1,38 +1,111 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import asyncio
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
-from config import BOT_TOKEN, create_tables
+from config import BOT_TOKEN, create_tables, init_db_pool, close_db_pool
 from handlers import router
+from middlewares import ThrottlingMiddleware, OutboundQueue
+from schedule_parser import warm_up_cache, get_all_schedule_urls, CACHE_DURATION_SECONDS, REFRESH_RETRY_SECONDS
+from ical import get_group_feed, FeedUnavailable
+from fetcher import FETCH_STATS, BREAKERS
 from aiohttp import web
 
+# Бот считается прогретым, когда загружена хотя бы эта доля файлов расписания
+WARMUP_MIN_LOADED_SHARE = 0.5
+# Состояние прогрева: /ready отвечает 200, только когда готово все
+READINESS = {"db": False, "cache": False}
+OUTBOUND_QUEUE = OutboundQueue()
+
+def log_phase(name, started):
+    print(f"⏱️ {name}: {time.perf_counter() - started:.2f} с")
+
 async def handle(request):
     return web.Response(text="✅ Bot is alive!", content_type="text/plain")
 
+async def handle_ready(request):
+    # Трафик на инстанс пускаем только после подключения к базе и прогрева кэша расписаний
+    if not all(READINESS.values()):
+        pending = ", ".join(name for name, ready in READINESS.items() if not ready)
+        return web.Response(status=503, text=f"⏳ Starting: {pending}", content_type="text/plain")
+    return web.Response(text="✅ Ready", content_type="text/plain")
+
+async def handle_metrics(request):
+    # Счетчики загрузки расписаний и отброшенных сообщений в текстовом формате Prometheus
+    lines = [f"schedule_fetch_{name}_total {value}" for name, value in sorted(FETCH_STATS.items())]
+    lines.append(f"telegram_send_dropped_total {OUTBOUND_QUEUE.dropped}")
+    lines += [f'schedule_fetch_circuit_open{{host="{host}"}} {int(breaker.is_open)}' for host, breaker in BREAKERS.items()]
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+async def handle_ical(request):
+    try:
+        feed = await get_group_feed(request.match_info["group"])
+    except FeedUnavailable:
+        raise web.HTTPServiceUnavailable(text="Расписание временно недоступно", headers={"Retry-After": str(REFRESH_RETRY_SECONDS)})
+    if feed is None:
+        raise web.HTTPNotFound(text="Группа не найдена")
+    etag, body, gzipped = feed
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": f"public, max-age={CACHE_DURATION_SECONDS}"}
+    # Календарные клиенты опрашивают ленту часто, поэтому отвечаем 304 без тела, если ничего не изменилось
+    if_none_match = request.headers.get("If-None-Match", "")
+    if "*" in if_none_match or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return web.Response(status=304, headers=headers)
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        body = gzipped
+    return web.Response(body=body, headers=headers, content_type="text/calendar", charset="utf-8")
+
 async def main():
-    # Создаем таблицы в базе данных
-    await create_tables()
-    
+    log_phase("Импорт модулей", STARTED_AT)
+
     bot = Bot(token=BOT_TOKEN)
+    bot.session.middleware(OUTBOUND_QUEUE)
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
+    throttling = ThrottlingMiddleware()
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
     dp.include_router(router)
 
-    # aiohttp сервер
+    # aiohttp сервер поднимаем сразу, чтобы /healthz отвечал во время прогрева
     app = web.Application()
     app.router.add_get("/", handle)
+    app.router.add_get("/healthz", handle)
+    app.router.add_get("/ready", handle_ready)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/ical/{group}.ics", handle_ical)
 
-    # Запуск Telegram бота и веб-сервера параллельно
-    async def run_bot():
-        await dp.start_polling(bot)
+    started = time.perf_counter()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", 10000)
+    await site.start()
+    print("🌐 Web server запущен на порту 10000")
+    log_phase("Запуск веб-сервера", started)
 
-    async def run_web():
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, "0.0.0.0", 10000)
-        await site.start()
-        print("🌐 Web server запущен на порту 10000")
+    try:
+        # Создаем пул соединений и таблицы в базе данных
+        started = time.perf_counter()
+        await init_db_pool()
+        await create_tables()
+        READINESS["db"] = True
+        log_phase("Подключение к базе данных", started)
 
-    await asyncio.gather(run_bot(), run_web())
+        started = time.perf_counter()
+        total = len(get_all_schedule_urls())
+        while (loaded := await warm_up_cache()) < total * WARMUP_MIN_LOADED_SHARE:
+            # Неудачные файлы повторно скачиваются не раньше чем через REFRESH_RETRY_SECONDS
+            print(f"⚠️ Загружено только {loaded} из {total} расписаний, повтор через {REFRESH_RETRY_SECONDS} с")
+            await asyncio.sleep(REFRESH_RETRY_SECONDS)
+        READINESS["cache"] = True
+        log_phase(f"Прогрев кэша расписаний ({loaded} из {total} файлов)", started)
+        log_phase("Запуск целиком", STARTED_AT)
+
+        await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+        await close_db_pool()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,201 @@
+import asyncio
+import contextlib
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import CallbackQuery, Message
+
+# ===== ЛИМИТЫ =====
+USER_RATE = 1.0            # запросов в секунду на пользователя
+USER_BURST = 5             # сколько запросов подряд можно сделать без ожидания
+EXPENSIVE_LIMIT = 1        # одновременных тяжелых операций на пользователя
+GLOBAL_SEND_RATE = 25      # сообщений в секунду на весь бот (лимит Telegram ~30)
+PRIVATE_CHAT_RATE = 1.0    # сообщений в секунду в личный чат
+GROUP_CHAT_RATE = 20 / 60  # сообщений в секунду в группу (лимит Telegram 20 в минуту)
+CHAT_BURST = 3
+MAX_SEND_DELAY_SECONDS = 10  # дольше ждать отправки нет смысла, сообщение отбрасывается
+SEND_ATTEMPTS = 3            # попыток отправки, если Telegram отвечает 429
+BUCKETS_PRUNE_INTERVAL = 60
+BUCKET_IDLE_SECONDS = 600
+
+
+class SendQueueOverflow(Exception):
+    """Очередь отправки переполнена: сообщение пришлось бы ждать дольше MAX_SEND_DELAY_SECONDS."""
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.warned = False
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self) -> bool:
+        """Забирает токен, если он есть. Возвращает False, если корзина пуста."""
+        self._refill()
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+    def delay(self) -> float:
+        """Сколько секунд придется ждать следующего токена, ничего не забирая."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self):
+        """Бронирует токен в долг (после проверки через delay)."""
+        self._refill()
+        self.tokens -= 1
+
+
+class BucketMap(dict):
+    """Корзины по ключу. Давно не использовавшиеся удаляются раз в BUCKETS_PRUNE_INTERVAL."""
+
+    def __init__(self):
+        super().__init__()
+        self.pruned_at = time.monotonic()
+
+    def get_bucket(self, key, rate: float, capacity: float) -> TokenBucket:
+        now = time.monotonic()
+        if now - self.pruned_at >= BUCKETS_PRUNE_INTERVAL:
+            self.pruned_at = now
+            for stale_key in [k for k, b in self.items() if now - b.updated >= BUCKET_IDLE_SECONDS]:
+                del self[stale_key]
+        bucket = self.get(key)
+        if bucket is None:
+            bucket = self[key] = TokenBucket(rate, capacity)
+        return bucket
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту запросов от одного пользователя и число его одновременных
+    тяжелых операций (хендлеры с флагом expensive, например поиск преподавателя).
+    """
+
+    def __init__(self, rate: float = USER_RATE, burst: int = USER_BURST, expensive_limit: int = EXPENSIVE_LIMIT):
+        self.rate = rate
+        self.burst = burst
+        self.expensive_limit = expensive_limit
+        self.buckets = BucketMap()
+        self.running = {}
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        bucket = self.buckets.get_bucket(user.id, self.rate, self.burst)
+        if not bucket.consume():
+            # Предупреждаем один раз, остальные запросы молча отбрасываем
+            if not bucket.warned:
+                bucket.warned = True
+                await _reply(event, "⏳ Слишком много запросов, подождите пару секунд.")
+            elif isinstance(event, CallbackQuery):
+                await event.answer()
+            return None
+        bucket.warned = False
+
+        if not get_flag(data, "expensive"):
+            return await handler(event, data)
+
+        if self.running.get(user.id, 0) >= self.expensive_limit:
+            await _reply(event, "⏳ Дождитесь окончания предыдущего поиска.")
+            return None
+        self.running[user.id] = self.running.get(user.id, 0) + 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.running[user.id] -= 1
+            if not self.running[user.id]: del self.running[user.id]
+
+
+async def _reply(event, text: str):
+    # Предупреждение о лимите не критично: при перегрузке очереди отправки просто не показываем его
+    with contextlib.suppress(SendQueueOverflow):
+        if isinstance(event, CallbackQuery):
+            await event.answer(text, show_alert=False)
+        elif isinstance(event, Message):
+            await event.answer(text)
+
+
+class OutboundQueue(BaseRequestMiddleware):
+    """
+    Единая очередь исходящих сообщений (answer/edit_text) с учетом лимитов Telegram.
+
+    Каждый запрос ждет своей очереди по общему лимиту бота и по лимиту конкретного чата,
+    поэтому при перегрузке хендлеры замедляются, а не получают 429. Если ждать пришлось бы
+    дольше MAX_SEND_DELAY_SECONDS, запрос сразу завершается SendQueueOverflow (хендлер ошибок
+    в handlers.py молча его отбрасывает). Повторные
+    правки одного и того же сообщения, пока предыдущая ждет отправки, склеиваются в одну.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_SEND_RATE):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = BucketMap()
+        self.pending_edits = {}
+        self.paused_until = 0.0
+        self.dropped = 0
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, (SendMessage, EditMessageText)):
+            return await make_request(bot, method)
+        if isinstance(method, SendMessage):
+            await self._wait_slot(method.chat_id)
+            return await self._send(make_request, bot, method)
+
+        key = (method.chat_id, method.message_id, method.inline_message_id)
+        pending = self.pending_edits.get(key)
+        if pending is not None:
+            # Правка еще не ушла: подменяем текст и ждем общий результат
+            pending[0] = method
+        else:
+            pending = self.pending_edits[key] = [method, None]
+            # Правку отправляет отдельная задача, чтобы отмена одного из ожидающих не мешала остальным
+            pending[1] = asyncio.ensure_future(self._send_edit(key, pending, make_request, bot))
+            pending[1].add_done_callback(lambda task: task.cancelled() or task.exception())
+        return await asyncio.shield(pending[1])
+
+    async def _send_edit(self, key, pending, make_request, bot):
+        try:
+            await self._wait_slot(pending[0].chat_id)
+        finally:
+            if self.pending_edits.get(key) is pending: del self.pending_edits[key]
+        return await self._send(make_request, bot, pending[0])
+
+    async def _wait_slot(self, chat_id):
+        buckets = [self.global_bucket]
+        if chat_id is not None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            buckets.append(self.chat_buckets.get_bucket(chat_id, GROUP_CHAT_RATE if is_group else PRIVATE_CHAT_RATE, CHAT_BURST))
+        delay = max([bucket.delay() for bucket in buckets] + [self.paused_until - time.monotonic()])
+        if delay > MAX_SEND_DELAY_SECONDS:
+            self.dropped += 1
+            raise SendQueueOverflow(f"очередь отправки переполнена, ожидание {delay:.0f} с")
+        for bucket in buckets: bucket.reserve()
+        if delay > 0: await asyncio.sleep(delay)
+
+    async def _send(self, make_request, bot, method):
+        for _ in range(SEND_ATTEMPTS - 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if e.retry_after > MAX_SEND_DELAY_SECONDS:
+                    self.dropped += 1
+                    raise SendQueueOverflow(f"Telegram просит подождать {e.retry_after} с") from e
+                # Притормаживаем всю очередь и встаем в нее заново, соблюдая лимиты
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                await self._wait_slot(method.chat_id)
+        return await make_request(bot, method)
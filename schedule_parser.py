@@ -1,17 +1,23 @@
+import asyncio
+import hashlib
 import io
 import re
 import time
 from datetime import datetime, timedelta
 
-import aiohttp
-import openpyxl
-import xlrd
-
 from config import SCHEDULE_URLS, TZ, get_note
+from fetcher import FETCH_STATS, FetchError, fetch_bytes
 
 # ===== ПЕРЕМЕННЫЕ ДЛЯ КЭШИРОВАНИЯ =====
 SCHEDULE_CACHE = {} 
 CACHE_DURATION_SECONDS = 3600
+# После неудачной загрузки не пробуем скачать тот же файл снова раньше этого срока
+REFRESH_RETRY_SECONDS = 60
+REFRESH_FAILED_AT = {}
+# Идущие сейчас загрузки: url -> задача, чтобы одновременные запросы качали файл один раз
+REFRESH_TASKS = {}
+# Сколько файлов расписания качать одновременно при прогреве и поиске по всем файлам
+FETCH_CONCURRENCY = 8
 
 # --- Константы ---
 RUS_DAYS_SHORT = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
@@ -48,34 +54,93 @@ def parse_russian_date(date_str: str):
                 except (ValueError, IndexError): continue
     return None
 
+def _parse_workbook(url: str, content: bytes) -> list:
+    data = []
+    # Библиотеки разбора Excel тяжелые, импортируем их только при первой загрузке
+    if ".xlsx" in url.lower():
+        import openpyxl
+        wb = openpyxl.load_workbook(io.BytesIO(content))
+        sheet = wb.active
+        for row in sheet.iter_rows(values_only=True):
+            data.append([cell or "" for cell in row])
+    else:
+        import xlrd
+        wb = xlrd.open_workbook(file_contents=content)
+        sheet = wb.sheet_by_index(0)
+        for r in range(sheet.nrows):
+            data.append([sheet.cell_value(r, c) or "" for c in range(sheet.ncols)])
+    return data
+
 async def _load_and_parse_xls(url: str):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status != 200: return None
-                content = await response.read()
-                data = []
-                if ".xlsx" in url.lower():
-                    wb = openpyxl.load_workbook(io.BytesIO(content))
-                    sheet = wb.active
-                    for row in sheet.iter_rows(values_only=True):
-                        data.append([cell or "" for cell in row])
-                else:
-                    wb = xlrd.open_workbook(file_contents=content)
-                    sheet = wb.sheet_by_index(0)
-                    for r in range(sheet.nrows):
-                        data.append([sheet.cell_value(r, c) or "" for c in range(sheet.ncols)])
-                return data
-    except Exception: return None
+        content = await fetch_bytes(url)
+    except FetchError: return None
+    try:
+        # Разбор занимает заметное время, в потоке он не блокирует event loop
+        data = await asyncio.to_thread(_parse_workbook, url, content)
+        return data, hashlib.sha1(content).hexdigest()
+    except Exception:
+        FETCH_STATS["parse_errors"] += 1
+        return None
 
 async def get_schedule_data_from_url(url: str):
+    cached = SCHEDULE_CACHE.get(url)
+    if cached and time.time() - cached[0] < CACHE_DURATION_SECONDS:
+        return cached[1]
+    task = REFRESH_TASKS.get(url)
+    if task is None:
+        task = REFRESH_TASKS[url] = asyncio.ensure_future(_refresh_schedule(url))
+        task.add_done_callback(lambda done: REFRESH_TASKS.pop(url, None) if REFRESH_TASKS.get(url) is done else None)
+    # shield: если один из ожидающих отменен, общая загрузка продолжается для остальных
+    return await asyncio.shield(task)
+
+async def _refresh_schedule(url: str):
     current_time = time.time()
-    if url in SCHEDULE_CACHE and current_time - SCHEDULE_CACHE[url][0] < CACHE_DURATION_SECONDS:
-        return SCHEDULE_CACHE[url][1]
-    new_data = await _load_and_parse_xls(url)
-    if new_data: SCHEDULE_CACHE[url] = (current_time, new_data)
+    cached = SCHEDULE_CACHE.get(url)
+    loaded = None
+    if current_time - REFRESH_FAILED_AT.get(url, 0) >= REFRESH_RETRY_SECONDS:
+        loaded = await _load_and_parse_xls(url)
+    if not loaded or not loaded[0]:
+        # Сервер недоступен или отдал мусор: показываем последнюю удачную версию
+        if current_time - REFRESH_FAILED_AT.get(url, 0) >= REFRESH_RETRY_SECONDS: REFRESH_FAILED_AT[url] = current_time
+        if not cached: return None
+        FETCH_STATS["stale_fallbacks"] += 1
+        return cached[1]
+    REFRESH_FAILED_AT.pop(url, None)
+    new_data, version = loaded
+    SCHEDULE_CACHE[url] = (current_time, new_data, version)
     return new_data
 
+def get_stale_since(url: str):
+    """Время последней удачной загрузки, если обновить файл вовремя не получилось, иначе None."""
+    cached = SCHEDULE_CACHE.get(url)
+    if cached and time.time() - cached[0] >= CACHE_DURATION_SECONDS:
+        return datetime.fromtimestamp(cached[0], TZ)
+    return None
+
+def get_schedule_version(url: str):
+    """Хэш содержимого закэшированного файла расписания, меняется вместе с файлом."""
+    return SCHEDULE_CACHE[url][2] if url in SCHEDULE_CACHE else None
+
+def get_all_schedule_urls() -> list:
+    urls = []
+    for faculties in SCHEDULE_URLS.values():
+        for courses in faculties.values():
+            for course_urls in courses.values():
+                urls.extend([course_urls] if isinstance(course_urls, str) else course_urls)
+    return urls
+
+async def warm_up_cache() -> int:
+    """Загружает в кэш все расписания, не больше FETCH_CONCURRENCY сразу. Возвращает число загруженных файлов."""
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+    async def load(url):
+        async with semaphore:
+            return await get_schedule_data_from_url(url)
+
+    results = await asyncio.gather(*(load(url) for url in get_all_schedule_urls()))
+    return sum(1 for data in results if data)
+
 def get_schedule_urls(faculty: str, course: int, is_even: bool) -> list:
     week_folder = "Четная неделя" if is_even else "Нечетная неделя"
     try:
@@ -141,12 +206,17 @@ async def get_day_schedule(user_id: int, faculty: str, course: int, group: str,
         target_date = now + timedelta(days=shift)
     
     found_lessons, found_week_is_even = None, None
+    stale_since, unavailable = None, False
     
     for is_even in [False, True]:
         urls = get_schedule_urls(faculty, course, is_even)
         for url in urls:
             schedule_data = await get_schedule_data_from_url(url)
-            if not schedule_data: continue
+            if not schedule_data:
+                unavailable = True
+                continue
+            url_stale_since = get_stale_since(url)
+            if url_stale_since and (stale_since is None or url_stale_since < stale_since): stale_since = url_stale_since
             group_column = find_group_column(schedule_data, group)
             if group_column == -1: continue
             lessons = find_schedule_for_date(schedule_data, group_column, target_date)
@@ -158,14 +228,14 @@ async def get_day_schedule(user_id: int, faculty: str, course: int, group: str,
     note = await get_note(user_id, target_date.date())
 
     if found_lessons is not None:
-        schedule_text = format_schedule(found_lessons, found_week_is_even, target_date, group, note)
+        schedule_text = format_schedule(found_lessons, found_week_is_even, target_date, group, note, stale_since)
     else:
         is_target_week_even = (target_date.isocalendar()[1] % 2 == 0)
-        schedule_text = format_schedule([], is_target_week_even, target_date, group, note)
+        schedule_text = format_schedule([], is_target_week_even, target_date, group, note, stale_since, unavailable)
         
     return schedule_text, target_date.date()
 
-def format_schedule(lessons, is_even, date, group, note=None):
+def format_schedule(lessons, is_even, date, group, note=None, stale_since=None, unavailable=False):
     date_str = f"{RUS_DAYS_SHORT[date.weekday()]} {date.day} {RUS_MONTHS[date.month]}"
     result = [
         f"*📅 {('Четная' if is_even else 'Нечетная')} неделя*",
@@ -173,7 +243,9 @@ def format_schedule(lessons, is_even, date, group, note=None):
         f"\n🟢__*{escape_markdown(date_str)}*__\n"
     ]
     
-    if not lessons:
+    if not lessons and unavailable:
+        result.append("⚠️ *Не удалось загрузить расписание, попробуйте позже\\.*")
+    elif not lessons:
         result.append("🎉 *Пар нет, можно отдыхать\\!*")
     else:
         unique_lessons = []
@@ -190,45 +262,67 @@ def format_schedule(lessons, is_even, date, group, note=None):
         result.append(f"\n*📌 Моя заметка на этот день:*")
         result.append(f"_{escape_markdown(note)}_")
 
+    if stale_since:
+        result.append(f"\n⚠️ _{escape_markdown(f'Сервер расписаний недоступен, показана версия от {stale_since:%d.%m %H:%M}')}_")
+
     return "\n".join(result)
 
-async def get_teacher_schedule(teacher_name: str, target_date: datetime):
-    all_findings = []
+def _find_teacher_in_workbook(schedule_data: list, teacher_name: str, target_date: datetime, is_even_week: bool) -> list:
+    findings = []
+    groups = {}
+    for i, row in enumerate(schedule_data):
+        if len(row) > 2 and "день" in str(row[0]).lower() and "часы" in str(row[1]).lower():
+            for col, cell in enumerate(row):
+                if col > 1 and str(cell).strip(): groups[col] = str(cell).strip()
+            break
+    if not groups: return findings
+    for i, row in enumerate(schedule_data):
+        parsed_date = parse_russian_date(str(row[0]))
+        if parsed_date and parsed_date.date() == target_date.date():
+            current_time = None
+            for j in range(i, len(schedule_data)):
+                current_row = schedule_data[j]
+                if j > i and current_row and current_row[0]:
+                    next_date = parse_russian_date(str(current_row[0]))
+                    if next_date and next_date.date() != target_date.date(): break
+                time_cell = current_row[1] if len(current_row) > 1 else ""
+                if time_cell and str(time_cell).strip(): current_time = str(time_cell).strip()
+                for col, group_name in groups.items():
+                    if col < len(current_row) and teacher_name.lower() in str(current_row[col]).lower():
+                        subject_lines = [line.strip().lstrip('-').strip() for line in str(current_row[col]).split('\n') if line.strip()]
+                        if current_time and subject_lines:
+                            findings.append({
+                                "time": current_time, "group": group_name,
+                                "details": tuple(subject_lines), "is_even": is_even_week
+                            })
+    return findings
+
+async def iter_teacher_schedule(teacher_name: str, target_date: datetime):
+    """
+    Асинхронный генератор поиска преподавателя: файлы загружаются и просматриваются параллельно,
+    после обработки каждого отдается (обработано файлов, всего файлов, найденные пары).
+    """
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+    async def scan(url, is_even_week):
+        async with semaphore:
+            schedule_data = await get_schedule_data_from_url(url)
+        if not schedule_data: return []
+        return await asyncio.to_thread(_find_teacher_in_workbook, schedule_data, teacher_name, target_date, is_even_week)
+
+    tasks = []
     for week_type, faculties in SCHEDULE_URLS.items():
         is_even_week = (week_type == "Четная неделя")
         for faculty, courses in faculties.items():
             for course, urls in courses.items():
                 url_list = [urls] if isinstance(urls, str) else urls
-                for url in url_list:
-                    schedule_data = await get_schedule_data_from_url(url)
-                    if not schedule_data: continue
-                    groups = {}
-                    for i, row in enumerate(schedule_data):
-                        if len(row) > 2 and "день" in str(row[0]).lower() and "часы" in str(row[1]).lower():
-                            for col, cell in enumerate(row):
-                                if col > 1 and str(cell).strip(): groups[col] = str(cell).strip()
-                            break
-                    if not groups: continue
-                    for i, row in enumerate(schedule_data):
-                        parsed_date = parse_russian_date(str(row[0]))
-                        if parsed_date and parsed_date.date() == target_date.date():
-                            current_time = None
-                            for j in range(i, len(schedule_data)):
-                                current_row = schedule_data[j]
-                                if j > i and current_row and current_row[0]:
-                                    next_date = parse_russian_date(str(current_row[0]))
-                                    if next_date and next_date.date() != target_date.date(): break
-                                time_cell = current_row[1] if len(current_row) > 1 else ""
-                                if time_cell and str(time_cell).strip(): current_time = str(time_cell).strip()
-                                for col, group_name in groups.items():
-                                    if col < len(current_row) and teacher_name.lower() in str(current_row[col]).lower():
-                                        subject_lines = [line.strip().lstrip('-').strip() for line in str(current_row[col]).split('\n') if line.strip()]
-                                        if current_time and subject_lines:
-                                            all_findings.append({
-                                                "time": current_time, "group": group_name,
-                                                "details": tuple(subject_lines), "is_even": is_even_week
-                                            })
-    return format_teacher_schedule(teacher_name, target_date, all_findings)
+                tasks += [asyncio.ensure_future(scan(url, is_even_week)) for url in url_list]
+    try:
+        for done, task in enumerate(asyncio.as_completed(tasks), 1):
+            yield done, len(tasks), await task
+    finally:
+        # Если поиск прервали, не оставляем висеть недокачанные файлы
+        for task in tasks: task.cancel()
 
 def format_teacher_schedule(teacher_name, date, findings):
     date_str = f"{RUS_DAYS_SHORT[date.weekday()]} {date.day} {RUS_MONTHS[date.month]}"